@@ -1,41 +1,70 @@
 import uproot
 import numpy as np
+import numba as nb
+import functools
 import importlib.resources
-from coffea.lookup_tools.dense_lookup import dense_lookup
 import awkward as ak
 
 
-def getSF(flav, CvL, CvB, file="DeepCSV_ctagSF_MiniAOD94X_2017_pTincl.root", syst=""):
-    # _btag_path = "BTVNanoCommissioning.data.BTV.Rereco17_94X"
+@functools.lru_cache(maxsize=None)
+def _load_SF_table(file, systsuff):
+    ## read the SF histograms once per file and variation
     with importlib.resources.path(
         file[: file.rfind("/")].replace("/", "."), file[file.rfind("/") + 1 :]
     ) as filename:
         f = uproot.open(filename)
 
-    if syst == "" or syst == "central":
-        systsuff = ""
-    else:
-        systsuff = "_" + syst
-
-    SFd = np.array(
+    SFd = np.ascontiguousarray(
         [
             f["SFl_hist" + systsuff].to_numpy()[0],
             f["SFc_hist" + systsuff].to_numpy()[0],
             f["SFb_hist" + systsuff].to_numpy()[0],
-        ]
+        ],
+        dtype=np.float64,
+    )
+    bins = (
+        np.ascontiguousarray(f["SFb_hist" + systsuff].to_numpy()[-1], dtype=np.float64),
+        np.ascontiguousarray(f["SFb_hist" + systsuff].to_numpy()[-2], dtype=np.float64),
+        np.array([0, 1, 2, 3], dtype=np.float64),
+    )
+    return SFd, bins
+
+
+@nb.njit
+def _lookup(values, edges0, edges1, edges2, x0, x1, x2):
+    ## same binning as coffea dense_lookup: right-closed search, clipped to the values
+    i0 = np.minimum(
+        np.maximum(np.searchsorted(edges0, x0, side="right") - 1, 0),
+        values.shape[0] - 1,
     )
-    bins = [
-        f["SFb_hist" + systsuff].to_numpy()[-1],
-        f["SFb_hist" + systsuff].to_numpy()[-2],
-        np.array([0, 1, 2, 3]),
-    ]
-    efflookup = dense_lookup(SFd, bins)
+    i1 = np.minimum(
+        np.maximum(np.searchsorted(edges1, x1, side="right") - 1, 0),
+        values.shape[1] - 1,
+    )
+    i2 = np.minimum(
+        np.maximum(np.searchsorted(edges2, x2, side="right") - 1, 0),
+        values.shape[2] - 1,
+    )
+    out = np.empty(len(x0), dtype=np.float64)
+    for k in range(len(x0)):
+        out[k] = values[i0[k], i1[k], i2[k]]
+    return out
+
+
+def getSF(flav, CvL, CvB, file="DeepCSV_ctagSF_MiniAOD94X_2017_pTincl.root", syst=""):
+    # _btag_path = "BTVNanoCommissioning.data.BTV.Rereco17_94X"
+    if syst == "" or syst == "central":
+        systsuff = ""
+    else:
+        systsuff = "_" + syst
+
+    SFd, bins = _load_SF_table(file, systsuff)
     flav = np.where(flav == 4, 1, flav)
     flav = np.where(flav == 5, 2, flav)
-    CvL = ak.to_numpy(CvL)
-    CvB = ak.to_numpy(CvB)
-    flav = ak.to_numpy(flav)
-    SFarr = efflookup(CvL, CvB, flav)
+    CvL = np.asarray(ak.to_numpy(CvL), dtype=np.float64)
+    CvB = np.asarray(ak.to_numpy(CvB), dtype=np.float64)
+    flav = np.asarray(ak.to_numpy(flav), dtype=np.float64)
+    SFarr = _lookup(SFd, bins[0], bins[1], bins[2], CvL, CvB, flav)
     if "Stat" in syst:
         return np.absolute(SFarr - getSF(flav, CvL, CvB, file))
     return SFarr
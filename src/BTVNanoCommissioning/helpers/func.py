@@ -1,4 +1,5 @@
 import awkward as ak
+import numba as nb
 import numpy as np
 from coffea import processor
 import psutil, os
@@ -16,6 +17,56 @@ def flatten(ar):  # flatten awkward into a 1d array to hist
     return ak.flatten(ar, axis=None)
 
 
+@nb.njit
+def _mujet_mask_kernel(
+    jet_offsets, jet_eta, jet_phi, jet_mu1, jet_mu2, mu_offsets, mu_eta, mu_phi, dr2
+):
+    out = np.ones(len(jet_eta), dtype=np.bool_)
+    for iev in range(len(jet_offsets) - 1):
+        for ij in range(jet_offsets[iev], jet_offsets[iev + 1]):
+            if jet_mu1[ij] == -1 and jet_mu2[ij] == -1:
+                out[ij] = False
+                continue
+            # stop at the first muon outside the cone
+            for im in range(mu_offsets[iev], mu_offsets[iev + 1]):
+                deta = jet_eta[ij] - mu_eta[im]
+                dphi = (jet_phi[ij] - mu_phi[im] + np.pi) % (2 * np.pi) - np.pi
+                if deta * deta + dphi * dphi > dr2:
+                    out[ij] = False
+                    break
+    return out
+
+
+def mujet_mask(jets, muons, drcut=0.4):
+    """Jets with an associated muon and all muons of the event within drcut,
+    same as ak.all(jets.metric_table(muons) <= drcut, axis=2) & muon index check
+    """
+    jet_counts = ak.to_numpy(ak.num(jets))
+    mu_counts = ak.to_numpy(ak.num(muons))
+    out = _mujet_mask_kernel(
+        np.concatenate(([0], np.cumsum(jet_counts))),
+        ak.to_numpy(ak.flatten(jets.eta)).astype(np.float64),
+        ak.to_numpy(ak.flatten(jets.phi)).astype(np.float64),
+        ak.to_numpy(ak.flatten(jets.muonIdx1)),
+        ak.to_numpy(ak.flatten(jets.muonIdx2)),
+        np.concatenate(([0], np.cumsum(mu_counts))),
+        ak.to_numpy(ak.flatten(muons.eta)).astype(np.float64),
+        ak.to_numpy(ak.flatten(muons.phi)).astype(np.float64),
+        drcut * drcut,
+    )
+    return ak.unflatten(out, jet_counts)
+
+
+def jet_lep_dr(jets, lep):
+    """Delta R of the jets to one lepton per event, lep from ak.firsts,
+    nan for all jets of events without a lepton so any dR cut fails
+    """
+    return np.hypot(
+        jets.eta - ak.fill_none(lep.eta, np.nan),
+        (jets.phi - ak.fill_none(lep.phi, np.nan) + np.pi) % (2 * np.pi) - np.pi,
+    )
+
+
 def normalize(val, cut):
     if cut is None:
         ar = ak.to_numpy(ak.fill_none(val, np.nan))
@@ -2,10 +2,12 @@ import importlib.resources
 import gzip
 import pickle
 import contextlib
+import functools
 import cloudpickle
 import os
 import re
 import copy
+import types
 import numpy as np
 import awkward as ak
 import uproot
@@ -314,6 +316,24 @@ def load_lumi(campaign):
         return LumiMask(filename)
 
 
+## Processors are unpickled for every chunk, keep the loaded corrections
+## per worker process instead of shipping them with the processor.
+## The cached objects are shared by all processors of the worker: the SF map is
+## handed out read-only, LumiMask only reads its run/lumi table when called
+@functools.lru_cache(maxsize=None)
+def _cached_SF(campaign, syst=False):
+    return load_SF(campaign, syst)
+
+
+def cached_SF(campaign, syst=False):
+    return types.MappingProxyType(_cached_SF(campaign, syst))
+
+
+@functools.lru_cache(maxsize=None)
+def cached_lumi(campaign):
+    return load_lumi(campaign)
+
+
 def jetveto(jets, correct_map):
     return ak.where(
         correct_map["jetveto"][list(correct_map["jetveto"].keys())[0]](
@@ -747,169 +767,43 @@ def btagSFs(jet, correct_map, weights, SFtype, syst=False):
             "lfstats1",
             "lfstats2",
         ]
-    sfs_up_all, sfs_down_all = {}, {}
+    if SFtype.startswith("DeepJet"):
+        sfname, cvl, cvb = "deepJet_shape", "btagDeepFlavCvL", "btagDeepFlavCvB"
+    else:
+        sfname, cvl, cvb = "deepCSV_shape", "btagDeepCvL", "btagDeepCvB"
+    evaluator = correct_map["ctag" if SFtype.endswith("C") else "btag"][sfname]
+
+    ## Flat inputs of all jets are built once and shared by central and all variations,
+    ## jet by jet blocks are concatenated so each variation is a single evaluator call
     alljet = jet if jet.ndim > 1 else ak.singletons(jet)
-    for i, sys in enumerate(systlist):
-        sfs, sfs_down, sfs_up = (
-            np.ones_like(alljet[:, 0].pt),
-            np.ones_like(alljet[:, 0].pt),
-            np.ones_like(alljet[:, 0].pt),
+    njet = ak.num(alljet.pt)[0]
+    jet_inputs = []
+    for nj in range(njet):
+        jet = alljet[:, nj]
+        jet_inputs.append(
+            (
+                ak.to_numpy(ak.is_none(jet.pt)),
+                ak.to_numpy(ak.fill_none(jet.hadronFlavour, 0)),
+                ak.to_numpy(ak.fill_none(jet[cvl], 0.0)),
+                ak.to_numpy(ak.fill_none(jet[cvb], 0.0)),
+            )
         )
-        for nj in range(ak.num(alljet.pt)[0]):
-            jet = alljet[:, nj]
-            masknone = ak.is_none(jet.pt)
-            jet.btagDeepFlavCvL = ak.fill_none(jet.btagDeepFlavCvL, 0.0)
-            jet.btagDeepFlavCvB = ak.fill_none(jet.btagDeepFlavCvB, 0.0)
-            jet.btagDeepCvL = ak.fill_none(jet.btagDeepCvL, 0.0)
-            jet.btagDeepCvB = ak.fill_none(jet.btagDeepCvB, 0.0)
-            jet.hadronFlavour = ak.fill_none(jet.hadronFlavour, 0)
-            if "correctionlib" in str(type(correct_map["ctag"])):
-                if SFtype == "DeepJetC":
-                    tmp_sfs = np.where(
-                        masknone,
-                        1.0,
-                        correct_map["ctag"]["deepJet_shape"].evaluate(
-                            "central",
-                            jet.hadronFlavour,
-                            jet.btagDeepFlavCvL,
-                            jet.btagDeepFlavCvB,
-                        ),
-                    )
-                    if syst:
-                        tmp_sfs_up = np.where(
-                            masknone,
-                            1.0,
-                            correct_map["ctag"]["deepJet_shape"].evaluate(
-                                f"up_{systlist[i]}",
-                                jet.hadronFlavour,
-                                jet.btagDeepFlavCvL,
-                                jet.btagDeepFlavCvB,
-                            ),
-                        )
-                        tmp_sfs_down = np.where(
-                            masknone,
-                            1.0,
-                            correct_map["ctag"]["deepJet_shape"].evaluate(
-                                f"down_{systlist[i]}",
-                                jet.hadronFlavour,
-                                jet.btagDeepFlavCvL,
-                                jet.btagDeepFlavCvB,
-                            ),
-                        )
-                if SFtype == "DeepCSVC":
-                    tmp_sfs = np.where(
-                        masknone,
-                        1.0,
-                        correct_map["ctag"]["deepCSV_shape"].evaluate(
-                            "central",
-                            jet.hadronFlavour,
-                            jet.btagDeepCvL,
-                            jet.btagDeepCvB,
-                        ),
-                    )
-                    tmp_sfs_up = np.where(
-                        masknone,
-                        1.0,
-                        correct_map["ctag"]["deepCSV_shape"].evaluate(
-                            f"up_{systlist[i]}",
-                            jet.hadronFlavour,
-                            jet.btagDeepCvL,
-                            jet.btagDeepCvB,
-                        ),
-                    )
-                    tmp_sfs_down = np.where(
-                        masknone,
-                        1.0,
-                        correct_map["ctag"]["deepCSV_shape"].evaluate(
-                            f"down_{systlist[i]}",
-                            jet.hadronFlavour,
-                            jet.btagDeepCvL,
-                            jet.btagDeepCvB,
-                        ),
-                    )
-            if "correctionlib" in str(type(correct_map["btag"])):
-                if SFtype == "DeepJetB":
-                    tmp_sfs = np.where(
-                        masknone,
-                        1.0,
-                        correct_map["btag"]["deepJet_shape"].evaluate(
-                            "central",
-                            jet.hadronFlavour,
-                            jet.btagDeepFlavCvL,
-                            jet.btagDeepFlavCvB,
-                        ),
-                    )
-                    if syst:
-                        tmp_sfs_up = np.where(
-                            masknone,
-                            1.0,
-                            correct_map["btag"]["deepJet_shape"].evaluate(
-                                f"up_{systlist[i]}",
-                                jet.hadronFlavour,
-                                jet.btagDeepFlavCvL,
-                                jet.btagDeepFlavCvB,
-                            ),
-                        )
-                        tmp_sfs_down = np.where(
-                            masknone,
-                            1.0,
-                            correct_map["btag"]["deepJet_shape"].evaluate(
-                                f"down_{systlist[i]}",
-                                jet.hadronFlavour,
-                                jet.btagDeepFlavCvL,
-                                jet.btagDeepFlavCvB,
-                            ),
-                        )
-                if SFtype == "DeepCSVB":
-                    tmp_sfs = np.where(
-                        masknone,
-                        1.0,
-                        correct_map["btag"]["deepCSV_shape"].evaluate(
-                            "central",
-                            jet.hadronFlavour,
-                            jet.btagDeepCvL,
-                            jet.btagDeepCvB,
-                        ),
-                    )
-                    tmp_sfs_up = np.where(
-                        masknone,
-                        1.0,
-                        correct_map["btag"]["deepCSV_shape"].evaluate(
-                            f"up_{systlist[i]}",
-                            jet.hadronFlavour,
-                            jet.btagDeepCvL,
-                            jet.btagDeepCvB,
-                        ),
-                    )
-                    tmp_sfs_down = np.where(
-                        masknone,
-                        1.0,
-                        correct_map["btag"]["deepCSV_shape"].evaluate(
-                            f"down_{systlist[i]}",
-                            jet.hadronFlavour,
-                            jet.btagDeepCvL,
-                            jet.btagDeepCvB,
-                        ),
-                    )
+    masknone, flav, jet_cvl, jet_cvb = (np.concatenate(arr) for arr in zip(*jet_inputs))
 
-            sfs = sfs * tmp_sfs
-            if syst:
-                sfs_up = sfs_up * tmp_sfs_up
-                sfs_down = sfs_down * tmp_sfs_down
+    def evaluate(var):
+        sfs = np.where(masknone, 1.0, evaluator.evaluate(var, flav, jet_cvl, jet_cvb))
+        return np.prod(sfs.reshape(njet, -1), axis=0)
 
-        if i == 0 and syst == False:
-            weights.add(SFtype, sfs)
-            break
-        else:
-            sfs_up_all[sys] = sfs_up
-            sfs_down_all[sys] = sfs_down
-    if syst == True:
+    sfs = evaluate("central")
+    if syst == False:
+        weights.add(SFtype, sfs)
+    else:
         weights.add_multivariation(
             SFtype,
             sfs,
             systlist,
-            np.array(list(sfs_up_all.values())),
-            np.array(list(sfs_down_all.values())),
+            np.array([evaluate(f"up_{sys}") for sys in systlist]),
+            np.array([evaluate(f"down_{sys}") for sys in systlist]),
         )
     return weights
 
@@ -917,6 +811,19 @@ def btagSFs(jet, correct_map, weights, SFtype, syst=False):
 ### Lepton SFs
 def eleSFs(ele, correct_map, weights, syst=True, isHLT=False):
     allele = ele if ele.ndim > 1 else ak.singletons(ele)
+    ## Per-electron inputs are shared by all SF types, converted to numpy once
+    ele_inputs = []
+    for nele in range(ak.num(allele.pt)[0]):
+        ele = allele[:, nele]
+        ele_inputs.append(
+            (
+                ele,
+                ak.to_numpy(ak.fill_none(ele.eta, -2.5)),
+                ak.to_numpy(ak.fill_none(ele.pt, 20)),
+                ak.to_numpy(ak.fill_none(ele.pt > 20.0, False)),
+                ak.to_numpy(ak.is_none(ele.pt)),
+            )
+        )
 
     for sf in correct_map["EGM_cfg"].keys():
         ## Only apply SFs for lepton pass HLT filter
@@ -925,12 +832,7 @@ def eleSFs(ele, correct_map, weights, syst=True, isHLT=False):
         sf_type = sf[: sf.find(" ")]
         if "low" in sf or "high" in sf:
             continue
-        for nele in range(ak.num(allele.pt)[0]):
-            ele = allele[:, nele]
-            ele_eta = ak.fill_none(ele.eta, -2.5)
-            ele_pt = ak.fill_none(ele.pt, 20)
-            mask = ele.pt > 20.0
-            masknone = ak.is_none(ele.pt)
+        for ele, ele_eta, ele_pt, mask, masknone in ele_inputs:
             sfs_alle, sfs_alle_up, sfs_alle_down = (
                 np.ones_like(allele[:, 0].pt),
                 np.ones_like(allele[:, 0].pt),
@@ -1211,6 +1113,18 @@ def eleSFs(ele, correct_map, weights, syst=True, isHLT=False):
 
 def muSFs(mu, correct_map, weights, syst=False, isHLT=False):
     allmu = mu if mu.ndim > 1 else ak.singletons(mu)
+    ## Per-muon inputs are shared by all SF types, converted to numpy once
+    mu_inputs = []
+    for nmu in range(ak.num(allmu.pt)[0]):
+        mu = allmu[:, nmu]
+        mu_inputs.append(
+            (
+                mu,
+                ak.to_numpy(ak.is_none(mu.pt)),
+                np.clip(ak.to_numpy(ak.fill_none(mu.pt, 15.0)), 15.0, 199.9),
+                np.clip(np.abs(ak.to_numpy(ak.fill_none(mu.eta, 0.0))), 0.0, 2.4),
+            )
+        )
     for sf in correct_map["MUO_cfg"].keys():
         ## Only apply SFs for lepton pass HLT filter
         if not isHLT and "HLT" in sf:
@@ -1223,12 +1137,7 @@ def muSFs(mu, correct_map, weights, syst=False, isHLT=False):
             np.ones_like(allmu[:, 0].pt),
         )
         sf_type = sf[: sf.find(" ")]
-        for nmu in range(ak.num(allmu.pt)[0]):
-            mu = allmu[:, nmu]
-            masknone = ak.is_none(mu.pt)
-
-            mu_pt = np.clip(mu.pt, 15.0, 199.9)
-            mu_eta = np.clip(np.abs(mu.eta), 0.0, 2.4)
+        for mu, masknone, mu_pt, mu_eta in mu_inputs:
             mask = mu_pt > 30
             sfs = 1.0
             if "correctionlib" in str(type(correct_map["MUO"])):
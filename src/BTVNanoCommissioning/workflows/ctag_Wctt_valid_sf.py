@@ -5,8 +5,8 @@ from coffea import processor
 from coffea.analysis_tools import Weights
 
 from BTVNanoCommissioning.utils.correction import (
-    load_lumi,
-    load_SF,
+    cached_lumi,
+    cached_SF,
     muSFs,
     eleSFs,
     puwei,
@@ -18,6 +18,8 @@ from BTVNanoCommissioning.helpers.func import (
     flatten,
     update,
     dump_lumi,
+    mujet_mask,
+    jet_lep_dr,
 )
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
 from BTVNanoCommissioning.utils.histogrammer import histogrammer
@@ -48,12 +50,17 @@ class NanoProcessor(processor.ProcessorABC):
         self.isSyst = isSyst
         self.isArray = isArray
         self.noHist = noHist
-        self.lumiMask = load_lumi(self._campaign)
         self.chunksize = chunksize
-        ## Load corrections
-        self.SF_map = load_SF(self._campaign)
         self.selMod = selectionModifier
 
+    @property
+    def lumiMask(self):
+        return cached_lumi(self._campaign)
+
+    @property
+    def SF_map(self):
+        return cached_SF(self._campaign)
+
     @property
     def accumulator(self):
         return self._accumulator
@@ -129,15 +136,11 @@ class NanoProcessor(processor.ProcessorABC):
             {"": None} if self.noHist else histogrammer(events, histoname[self.selMod])
         )
 
+        # sumw is a plain number, no accumulator needs to be built per chunk
         output = {
-            "sumw": processor.defaultdict_accumulator(float),
+            "sumw": len(events) if isRealData else ak.sum(events.genWeight),
             **_hist_event_dict,
         }
-
-        if isRealData:
-            output["sumw"] = len(events)
-        else:
-            output["sumw"] = ak.sum(events.genWeight)
         ####################
         #    Selections    #
         ####################
@@ -150,48 +153,42 @@ class NanoProcessor(processor.ProcessorABC):
             output = dump_lumi(events[req_lumi], output)
 
         ## HLT
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
+        checkHLT = [hasattr(events.HLT, _trig) for _trig in triggers]
+        if not any(checkHLT):
             raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(np.array(triggers)[~checkHLT], " not exist in", dataset)
+        elif not all(checkHLT):
+            print(np.array(triggers)[~np.array(checkHLT)], " not exist in", dataset)
         trig_arrs = [
-            events.HLT[_trig] for _trig in triggers if hasattr(events.HLT, _trig)
+            ak.to_numpy(events.HLT[_trig])
+            for _trig, valid in zip(triggers, checkHLT)
+            if valid
         ]
-        req_trig = np.zeros(len(events), dtype="bool")
-        for t in trig_arrs:
-            req_trig = req_trig | t
+        req_trig = np.logical_or.reduce(trig_arrs, axis=0)
 
         ## Lepton cuts
+        # lepton ID masks are reused by the isolated lepton and dilepton veto
+        mu_idiso_mask = mu_idiso(events, self._campaign)
+        ele_tight_mask = ele_mvatightid(events, self._campaign)
         if isMu:
             # muon twiki: https://twiki.cern.ch/twiki/bin/view/CMS/SWGuideMuonIdRun2
-            iso_lep = events.Muon[
-                (events.Muon.pt > 30) & mu_idiso(events, self._campaign)
-            ]
+            iso_lep_mask = (events.Muon.pt > 30) & mu_idiso_mask
+            iso_lep = events.Muon[iso_lep_mask]
         elif isEle:
-            iso_lep = events.Electron[
-                (events.Electron.pt > 34) & ele_mvatightid(events, self._campaign)
-            ]
-        req_lep = ak.count(iso_lep.pt, axis=1) == 1
+            iso_lep_mask = (events.Electron.pt > 34) & ele_tight_mask
+            iso_lep = events.Electron[iso_lep_mask]
+        req_lep = ak.num(iso_lep, axis=1) == 1
+        iso_lep = ak.firsts(iso_lep)
+        # only single lepton events are kept, clean the jets against that lepton
+        dr_lepjet = jet_lep_dr(events.Jet, iso_lep)
         jet_sel = ak.fill_none(
-            jet_id(events, self._campaign)
-            & (ak.all(events.Jet.metric_table(iso_lep) > 0.5, axis=2)),
+            jet_id(events, self._campaign) & (dr_lepjet > 0.5),
             False,
             axis=-1,
         )
-        iso_lep = ak.pad_none(iso_lep, 1, axis=1)
-        iso_lep = iso_lep[:, 0]
-        if isMu:
-            iso_lepindx = ak.mask(
-                ak.local_index(events.Muon.pt),
-                ((events.Muon.pt > 30) & mu_idiso(events, self._campaign)) == 1,
-            )
-        elif isEle:
-            iso_lepindx = ak.mask(
-                ak.local_index(events.Electron.pt),
-                ((events.Electron.pt > 34) & ele_mvatightid(events, self._campaign))
-                == 1,
-            )
+        iso_lepindx = ak.mask(
+            ak.local_index(iso_lep_mask),
+            iso_lep_mask == 1,
+        )
         iso_lepindx = ak.pad_none(iso_lepindx, 1)
         iso_lepindx = iso_lepindx[:, 0]
 
@@ -199,7 +196,7 @@ class NanoProcessor(processor.ProcessorABC):
         if "DeepJet_nsv" in events.Jet.fields:
             jet_sel = jet_sel & (events.Jet.DeepJet_nsv > 0)
         event_jet = events.Jet[jet_sel]
-        nseljet = ak.count(event_jet.pt, axis=1)
+        nseljet = ak.num(event_jet, axis=1)
         if "Wc" in self.selMod:
             req_jets = (nseljet >= 1) & (nseljet <= 3)
         else:
@@ -210,11 +207,10 @@ class NanoProcessor(processor.ProcessorABC):
             softmu_mask(events, self._campaign)
             & (abs(events.Muon.dxy / events.Muon.dxyErr) > dxySigcut)
         ]
-        req_softmu = ak.count(soft_muon.pt, axis=1) >= 1
+        req_softmu = ak.num(soft_muon, axis=1) >= 1
         mujetsel = ak.fill_none(
             (
-                (ak.all(event_jet.metric_table(soft_muon) <= 0.4, axis=2))
-                & ((event_jet.muonIdx1 != -1) | (event_jet.muonIdx2 != -1))
+                mujet_mask(event_jet, soft_muon)
                 & ((event_jet.muEF + event_jet.neEmEF) < muNeEmSum)
                 & (event_jet.pt > 20)
                 & ((event_jet.pt / event_jet.E) > 0.03)
@@ -222,42 +218,35 @@ class NanoProcessor(processor.ProcessorABC):
             False,
             axis=-1,
         )
-        mujetsel2 = ak.fill_none(
-            (
-                ((events.Jet.muEF + events.Jet.neEmEF) < muNeEmSum)
-                & (
-                    ak.all(
-                        events.Jet.metric_table(soft_muon) <= 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                )
-                & ((events.Jet.muonIdx1 != -1) | (events.Jet.muonIdx2 != -1))
-            ),
-            False,
-            axis=-1,
-        )
-        soft_muon = ak.pad_none(soft_muon, 1, axis=1)
+
+        ## store jet index for PFCands, create mask on the jet index
+        # only needed, and only evaluated, when PFCands are stored
+        if "PFCands" in events.fields:
+            mujetsel2 = ak.fill_none(
+                (
+                    ((events.Jet.muEF + events.Jet.neEmEF) < muNeEmSum)
+                    & mujet_mask(events.Jet, soft_muon)
+                    & req_softmu
+                ),
+                False,
+                axis=-1,
+            )
+            jet_selpf = (jet_sel) & (mujetsel2)
+            if "DeepJet_nsv" in events.Jet.fields:
+                jet_selpf = jet_selpf & (events.Jet.DeepJet_nsv > 0)
+            jetindx = ak.mask(ak.local_index(events.Jet.pt), jet_selpf == True)
+            jetindx = ak.pad_none(jetindx, 1)
+            jetindx = jetindx[:, 0]
         soft_muon["dxySig"] = soft_muon.dxy / soft_muon.dxyErr
 
         ## Muon-jet cuts
         event_jet["isMuonJet"] = mujetsel
         mu_jet = event_jet[mujetsel]
         otherjets = event_jet[~mujetsel]
-        req_mujet = ak.num(mu_jet.pt, axis=1) >= 1
-        mu_jet = ak.pad_none(mu_jet, 1, axis=1)
-
-        ## store jet index for PFCands, create mask on the jet index
-        jet_selpf = (jet_sel) & (mujetsel2)
-        if "DeepJet_nsv" in events.Jet.fields:
-            jet_selpf = jet_selpf & (events.Jet.DeepJet_nsv > 0)
-        jetindx = ak.mask(ak.local_index(events.Jet.pt), jet_selpf == True)
-        jetindx = ak.pad_none(jetindx, 1)
-        jetindx = jetindx[:, 0]
+        req_mujet = ak.num(mu_jet, axis=1) >= 1
 
         # Other cuts
-        req_pTratio = (soft_muon[:, 0].pt / mu_jet[:, 0].pt) < muonpTratioCut
-        idx = np.where(iso_lep.jetIdx == -1, 0, iso_lep.jetIdx)
+        req_pTratio = (ak.firsts(soft_muon).pt / ak.firsts(mu_jet).pt) < muonpTratioCut
         ## Additional cut to reject QCD events,used in BTV-20-001
         # req_QCDveto = (
         #     (iso_lep.pfRelIso04_all < 0.05)
@@ -276,15 +265,11 @@ class NanoProcessor(processor.ProcessorABC):
         # )
         # )
 
-        dilep_mu = events.Muon[(events.Muon.pt > 12) & mu_idiso(events, self._campaign)]
-        dilep_ele = events.Electron[
-            (events.Electron.pt > 15) & ele_mvatightid(events, self._campaign)
-        ]
-        req_dilepveto = (
-            ak.count(dilep_mu.pt, axis=1) + ak.count(dilep_ele.pt, axis=1) != 2
-        )
+        dilep_mu = events.Muon[(events.Muon.pt > 12) & mu_idiso_mask]
+        dilep_ele = events.Electron[(events.Electron.pt > 15) & ele_tight_mask]
+        req_dilepveto = ak.num(dilep_mu, axis=1) + ak.num(dilep_ele, axis=1) != 2
 
-        dilep_mass = iso_lep + soft_muon[:, 0]
+        dilep_mass = iso_lep + ak.firsts(soft_muon)
         if isMu:
             req_dilepmass = (dilep_mass.mass > 12.0) & (
                 (dilep_mass.mass < 80) | (dilep_mass.mass > 100)
@@ -300,26 +285,17 @@ class NanoProcessor(processor.ProcessorABC):
             },
             with_name="PtEtaPhiMLorentzVector",
         )
-        if "Run3" not in self._campaign:
-            MET = ak.zip(
-                {
-                    "pt": events.MET.pt,
-                    "eta": ak.zeros_like(events.MET.pt),
-                    "phi": events.MET.phi,
-                    "mass": ak.zeros_like(events.MET.pt),
-                },
-                with_name="PtEtaPhiMLorentzVector",
-            )
-        else:
-            MET = ak.zip(
-                {
-                    "pt": events.PuppiMET.pt,
-                    "eta": ak.zeros_like(events.PuppiMET.pt),
-                    "phi": events.PuppiMET.phi,
-                    "mass": ak.zeros_like(events.PuppiMET.pt),
-                },
-                with_name="PtEtaPhiMLorentzVector",
-            )
+        met = events.MET if "Run3" not in self._campaign else events.PuppiMET
+        met_zeros = ak.zeros_like(met.pt)
+        MET = ak.zip(
+            {
+                "pt": met.pt,
+                "eta": met_zeros,
+                "phi": met.phi,
+                "mass": met_zeros,
+            },
+            with_name="PtEtaPhiMLorentzVector",
+        )
 
         wmasscut = 55
         if "semitt" in self.selMod:
@@ -336,20 +312,25 @@ class NanoProcessor(processor.ProcessorABC):
         dphi = np.where(dphi>np.pi,dphi-2*np.pi,dphi)
         trans = np.sqrt(2*iso_lep.pt*events.PuppiMET.pt*(1-np.cos(dphi)))
         """
-        event_level = (
-            req_trig
-            & req_lumi
-            & req_lep
-            & req_jets
-            & req_softmu
-            & req_dilepmass
-            & req_mujet
-            & req_mtw
-            & req_dilepveto
-            & req_pTratio
+        # fold all requirements in one pass, tightest cuts first
+        event_level = np.logical_and.reduce(
+            [
+                ak.to_numpy(ak.fill_none(req, False))
+                for req in (
+                    req_trig,
+                    req_lep,
+                    req_lumi,
+                    req_jets,
+                    req_softmu,
+                    req_mujet,
+                    req_dilepmass,
+                    req_mtw,
+                    req_dilepveto,
+                    req_pTratio,
+                )
+            ]
         )
-        event_level = ak.fill_none(event_level, False)
-        if len(events[event_level]) == 0:
+        if not np.any(event_level):
             if self.isArray:
                 array_writer(
                     self,
@@ -374,10 +355,10 @@ class NanoProcessor(processor.ProcessorABC):
         smuon_jet = mu_jet[event_level]
         sotherjets = otherjets[event_level]
         sdilep = dilep_mass[event_level]
-        nsoftmu = ak.count(ssmu.pt, axis=1)
-        nmujet = ak.count(smuon_jet.pt, axis=1)
-        smuon_jet = smuon_jet[:, 0]
-        ssmu = ssmu[:, 0]
+        nsoftmu = ak.num(ssmu, axis=1)
+        nmujet = ak.num(smuon_jet, axis=1)
+        smuon_jet = ak.firsts(smuon_jet)
+        ssmu = ak.firsts(ssmu)
         sz = shmu + ssmu
         sw = shmu + smet
 
@@ -386,7 +367,7 @@ class NanoProcessor(processor.ProcessorABC):
         if "Wc" in self.selMod:
             osss = shmu.charge * ssmu.charge * -1
 
-        njet = ak.count(sjets.pt, axis=1)
+        njet = ak.num(sjets, axis=1)
         # Find the PFCands associate with selected jets. Search from jetindex->JetPFCands->PFCand
         if "PFCands" in events.fields:
             spfcands = events[event_level].PFCands[
@@ -431,6 +412,10 @@ class NanoProcessor(processor.ProcessorABC):
         else:
             genflavor = ak.zeros_like(sjets.pt, dtype=int)
             smflav = ak.zeros_like(smuon_jet.pt, dtype=int)
+        # per-event fill inputs as numpy, converted once for all histograms
+        smflav = ak.to_numpy(ak.fill_none(smflav, 0))
+        if "Wc" in self.selMod:
+            osss = ak.to_numpy(ak.fill_none(osss, 0))
 
         # Systematics information
         if shift_name is None:
@@ -447,126 +432,167 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         #  Fill histogram  #
         ####################
-        for syst in systematics:
-            if self.isSyst == False and syst != "nominal":
-                break
-            if self.noHist:
-                break
-            weight = (
-                weights.weight()
-                if syst == "nominal" or syst == shift_name
-                else weights.weight(modifier=syst)
-            )
-            for histname, h in output.items():
+        # weights shared by all histograms, evaluated once instead of per fill
+        if not self.noHist:
+            nobtag_weight = weights.partial_weight(exclude=exclude_btv)
+            # per-jet weights are repeated directly from the per-event ones
+            jet_counts = ak.to_numpy(ak.num(sjets))
+            jet_nobtag_weight = np.repeat(nobtag_weight, jet_counts)
+            jet_osss = flatten(ak.broadcast_arrays(osss, sjets["pt"])[0])
+            jet_genflavor = flatten(genflavor)
+            if "PFCands" in events.fields:
+                pf_smflav = flatten(ak.broadcast_arrays(smflav, spfcands["pt"])[0])
+                pf_osss = flatten(ak.broadcast_arrays(osss, spfcands["pt"])[0])
+                pf_nobtag_weight = np.repeat(
+                    nobtag_weight, ak.to_numpy(ak.fill_none(ak.num(spfcands), 0))
+                )
+            # classify histograms and resolve their branches once, the fill loop
+            # then only runs over each bucket without any name lookups
+            hist_buckets = {
+                "deep": [],
+                "pfcands": [],
+                "jet": [],
+                "hl": [],
+                "soft_l": [],
+                "mujet": [],
+                "btag": [],
+                "btag_trans": [],
+            }
+            for histname in output.keys():
                 if (
                     "Deep" in histname
                     and "btag" not in histname
                     and histname in events.Jet.fields
                 ):
-                    h.fill(
-                        syst,
-                        flatten(genflavor),
-                        flatten(ak.broadcast_arrays(osss, sjets["pt"])[0]),
-                        flatten(sjets[histname]),
-                        weight=flatten(
-                            ak.broadcast_arrays(
-                                weights.partial_weight(exclude=exclude_btv), sjets["pt"]
-                            )[0]
-                        ),
-                    )
+                    hist_buckets["deep"].append((histname, flatten(sjets[histname])))
                 elif (
                     "PFCands" in events.fields
                     and "PFCands" in histname
                     and histname.split("_")[1] in events.PFCands.fields
                 ):
-                    h.fill(
-                        syst,
-                        flatten(ak.broadcast_arrays(smflav, spfcands["pt"])[0]),
-                        flatten(ak.broadcast_arrays(osss, spfcands["pt"])[0]),
-                        flatten(spfcands[histname.replace("PFCands_", "")]),
-                        weight=flatten(
-                            ak.broadcast_arrays(
-                                weights.partial_weight(exclude=exclude_btv),
-                                spfcands["pt"],
-                            )[0]
-                        ),
+                    hist_buckets["pfcands"].append(
+                        (histname, flatten(spfcands[histname.replace("PFCands_", "")]))
                     )
                 elif "jet_" in histname and "mu" not in histname:
-                    h.fill(
-                        syst,
-                        flatten(genflavor),
-                        flatten(ak.broadcast_arrays(osss, sjets["pt"])[0]),
-                        flatten(sjets[histname.replace("jet_", "")]),
-                        weight=flatten(ak.broadcast_arrays(weight, sjets["pt"])[0]),
+                    hist_buckets["jet"].append(
+                        (histname, flatten(sjets[histname.replace("jet_", "")]))
                     )
                 elif "hl_" in histname and histname.replace("hl_", "") in shmu.fields:
-                    h.fill(
-                        syst,
-                        osss,
-                        flatten(shmu[histname.replace("hl_", "")]),
-                        weight=weight,
+                    hist_buckets["hl"].append(
+                        (histname, flatten(shmu[histname.replace("hl_", "")]))
                     )
                 elif (
                     "soft_l" in histname
                     and histname.replace("soft_l_", "") in ssmu.fields
                 ):
-                    h.fill(
-                        syst,
-                        smflav,
-                        osss,
-                        flatten(ssmu[histname.replace("soft_l_", "")]),
-                        weight=weight,
+                    hist_buckets["soft_l"].append(
+                        (histname, flatten(ssmu[histname.replace("soft_l_", "")]))
                     )
                 elif "mujet_" in histname:
-                    h.fill(
-                        syst,
-                        smflav,
-                        osss,
-                        flatten(smuon_jet[histname.replace("mujet_", "")]),
-                        weight=weight,
+                    hist_buckets["mujet"].append(
+                        (histname, flatten(smuon_jet[histname.replace("mujet_", "")]))
                     )
                 elif "btag" in histname and "Trans" not in histname:
+                    # clip the discriminator once, it is shared by all fills
                     for i in range(2):
                         if (
                             str(i) not in histname
                             or histname.replace(f"_{i}", "") not in events.Jet.fields
                         ):
                             continue
-                        h.fill(
-                            syst="noSF",
-                            flav=smflav,
-                            osss=osss,
-                            discr=np.where(
-                                smuon_jet[histname.replace(f"_{i}", "")] < 0,
-                                -0.2,
-                                smuon_jet[histname.replace(f"_{i}", "")],
-                            ),
-                            weight=weights.partial_weight(exclude=exclude_btv),
+                        discr = smuon_jet[histname.replace(f"_{i}", "")]
+                        hist_buckets["btag"].append(
+                            (histname, np.where(discr < 0, -0.2, discr))
                         )
-                        if not isRealData and "btag" in self.SF_map.keys():
-                            h.fill(
-                                syst=syst,
-                                flav=smflav,
-                                osss=osss,
-                                discr=np.where(
-                                    smuon_jet[histname.replace(f"_{i}", "")] < 0,
-                                    -0.2,
-                                    smuon_jet[histname.replace(f"_{i}", "")],
-                                ),
-                                weight=weight,
-                            )
                 elif "btag" in histname and "Trans" in histname:
-                    if histname not in smuon_jet:
-                        continue
-                    for i in range(2):
-                        histname = histname.replace("Trans", "").replace(f"_{i}", "")
-                        h.fill(
-                            syst="noSF",
-                            flav=smflav,
-                            osss=osss,
-                            discr=1.0 / np.tanh(smuon_jet[histname]),
-                            weight=weights.partial_weight(exclude=exclude_btv),
-                        )
+                    hist_buckets["btag_trans"].append(histname)
+        for syst in systematics:
+            if self.isSyst == False and syst != "nominal":
+                break
+            if self.noHist:
+                break
+            weight = (
+                weights.weight()
+                if syst == "nominal" or syst == shift_name
+                else weights.weight(modifier=syst)
+            )
+            jet_weight = np.repeat(weight, jet_counts)
+            for histname, var in hist_buckets["deep"]:
+                output[histname].fill(
+                    syst,
+                    jet_genflavor,
+                    jet_osss,
+                    var,
+                    weight=jet_nobtag_weight,
+                )
+            for histname, var in hist_buckets["pfcands"]:
+                output[histname].fill(
+                    syst,
+                    pf_smflav,
+                    pf_osss,
+                    var,
+                    weight=pf_nobtag_weight,
+                )
+            for histname, var in hist_buckets["jet"]:
+                output[histname].fill(
+                    syst,
+                    jet_genflavor,
+                    jet_osss,
+                    var,
+                    weight=jet_weight,
+                )
+            for histname, var in hist_buckets["hl"]:
+                output[histname].fill(
+                    syst,
+                    osss,
+                    var,
+                    weight=weight,
+                )
+            for histname, var in hist_buckets["soft_l"]:
+                output[histname].fill(
+                    syst,
+                    smflav,
+                    osss,
+                    var,
+                    weight=weight,
+                )
+            for histname, var in hist_buckets["mujet"]:
+                output[histname].fill(
+                    syst,
+                    smflav,
+                    osss,
+                    var,
+                    weight=weight,
+                )
+            for histname, discr in hist_buckets["btag"]:
+                output[histname].fill(
+                    syst="noSF",
+                    flav=smflav,
+                    osss=osss,
+                    discr=discr,
+                    weight=nobtag_weight,
+                )
+                if not isRealData and "btag" in self.SF_map.keys():
+                    output[histname].fill(
+                        syst=syst,
+                        flav=smflav,
+                        osss=osss,
+                        discr=discr,
+                        weight=weight,
+                    )
+            for histname in hist_buckets["btag_trans"]:
+                h = output[histname]
+                if histname not in smuon_jet:
+                    continue
+                for i in range(2):
+                    histname = histname.replace("Trans", "").replace(f"_{i}", "")
+                    h.fill(
+                        syst="noSF",
+                        flav=smflav,
+                        osss=osss,
+                        discr=1.0 / np.tanh(smuon_jet[histname]),
+                        weight=nobtag_weight,
+                    )
 
             output["njet"].fill(syst, osss, njet, weight=weight)
             output["nmujet"].fill(syst, osss, nmujet, weight=weight)
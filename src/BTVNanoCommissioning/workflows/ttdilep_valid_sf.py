@@ -6,8 +6,8 @@ from coffea.analysis_tools import Weights
 
 # functions to load SFs, corrections
 from BTVNanoCommissioning.utils.correction import (
-    load_lumi,
-    load_SF,
+    cached_lumi,
+    cached_SF,
     eleSFs,
     muSFs,
     puwei,
@@ -21,6 +21,7 @@ from BTVNanoCommissioning.helpers.func import (
     flatten,
     update,
     dump_lumi,
+    jet_lep_dr,
 )
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
 
@@ -52,10 +53,15 @@ class NanoProcessor(processor.ProcessorABC):
         self.isSyst = isSyst
         self.isArray = isArray
         self.noHist = noHist
-        self.lumiMask = load_lumi(self._campaign)
         self.chunksize = chunksize
-        ## Load corrections
-        self.SF_map = load_SF(self._campaign)
+
+    @property
+    def lumiMask(self):
+        return cached_lumi(self._campaign)
+
+    @property
+    def SF_map(self):
+        return cached_SF(self._campaign)
 
     @property
     def accumulator(self):
@@ -135,98 +141,64 @@ class NanoProcessor(processor.ProcessorABC):
             "Mu12_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL_DZ",
             "Mu8_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL_DZ",
         ]
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
+        checkHLT = [hasattr(events.HLT, _trig) for _trig in triggers]
+        if not any(checkHLT):
             raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(np.array(triggers)[~checkHLT], " not exist in", dataset)
+        elif not all(checkHLT):
+            print(np.array(triggers)[~np.array(checkHLT)], " not exist in", dataset)
         trig_arrs = [
-            events.HLT[_trig] for _trig in triggers if hasattr(events.HLT, _trig)
+            ak.to_numpy(events.HLT[_trig])
+            for _trig, valid in zip(triggers, checkHLT)
+            if valid
         ]
-        req_trig = np.zeros(len(events), dtype="bool")
-        for t in trig_arrs:
-            req_trig = req_trig | t
+        req_trig = np.logical_or.reduce(trig_arrs, axis=0)
 
         ## Muon cuts
         # muon twiki: https://twiki.cern.ch/twiki/bin/view/CMS/SWGuideMuonIdRun2
         events.Muon = events.Muon[
             (events.Muon.pt > 30) & mu_idiso(events, self._campaign)
         ]
-        events.Muon = ak.pad_none(events.Muon, 1, axis=1)
-        req_muon = ak.count(events.Muon.pt, axis=1) == 1
+        req_muon = ak.to_numpy(ak.num(events.Muon, axis=1)) == 1
 
         ## Electron cuts
         # electron twiki: https://twiki.cern.ch/twiki/bin/viewauth/CMS/CutBasedElectronIdentificationRun2
         events.Electron = events.Electron[
             (events.Electron.pt > 30) & ele_cuttightid(events, self._campaign)
         ]
-        events.Electron = ak.pad_none(events.Electron, 1, axis=1)
-        req_ele = ak.count(events.Electron.pt, axis=1) == 1
+        req_ele = ak.to_numpy(ak.num(events.Electron, axis=1)) == 1
 
         ## Jet cuts
-        event_jet = events.Jet[
-            ak.fill_none(
-                jet_id(events, self._campaign)
-                & (
-                    ak.all(
-                        events.Jet.metric_table(events.Muon) > 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                )
-                & (
-                    ak.all(
-                        events.Jet.metric_table(events.Electron) > 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                ),
-                False,
-            )
-        ]
-        req_jets = ak.num(event_jet.pt) >= 2
+        # only events with exactly one muon and one electron are kept, so the jets
+        # are cleaned against the leading leptons directly
+        lead_mu = ak.firsts(events.Muon)
+        lead_ele = ak.firsts(events.Electron)
+        # the lepton dR is only evaluated for jets passing the jet ID
+        jid = jet_id(events, self._campaign)
+        cand_jet = events.Jet[jid]
+        dr_jetmu = jet_lep_dr(cand_jet, lead_mu)
+        dr_jetele = jet_lep_dr(cand_jet, lead_ele)
+        jet_clean = ak.fill_none((dr_jetmu > 0.4) & (dr_jetele > 0.4), False)
+        event_jet = cand_jet[jet_clean]
+        req_jets = ak.to_numpy(ak.num(event_jet, axis=1)) >= 2
 
         ## Other cuts
+        # missing leptons get charge 0 and fail the product test
         req_opposite_charge = (
-            events.Electron[:, 0:1].charge * events.Muon[:, 0:1].charge
+            ak.to_numpy(ak.fill_none(lead_ele.charge, 0))
+            * ak.to_numpy(ak.fill_none(lead_mu.charge, 0))
         ) == -1
-        req_opposite_charge = ak.fill_none(req_opposite_charge, False)
-        req_opposite_charge = ak.flatten(req_opposite_charge)
-
-        ## store jet index for PFCands, create mask on the jet index
-        jetindx = ak.mask(
-            ak.local_index(events.Jet.pt),
-            (
-                jet_id(events, self._campaign)
-                & (
-                    ak.all(
-                        events.Jet.metric_table(events.Muon) > 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                )
-                & (
-                    ak.all(
-                        events.Jet.metric_table(events.Electron) > 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                )
-            )
-            == 1,
-        )
-        jetindx = ak.pad_none(jetindx, 2)
-        jetindx = jetindx[:, :2]
 
-        event_level = (
-            req_trig & req_lumi & req_muon & req_ele & req_jets & req_opposite_charge
+        # all requirements are numpy booleans, fold them in one pass
+        event_level = np.logical_and.reduce(
+            [req_trig, req_lumi, req_muon, req_ele, req_jets, req_opposite_charge]
         )
-        event_level = ak.fill_none(event_level, False)
-        if len(events[event_level]) == 0:
+        # selected event indices, found once and reused for every slice below
+        sel_idx = np.flatnonzero(event_level)
+        if sel_idx.size == 0:
             if self.isArray:
                 array_writer(
                     self,
-                    events[event_level],
+                    events[sel_idx],
                     events,
                     "nominal",
                     dataset,
@@ -238,45 +210,55 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         # Selected objects #
         ####################
-        smu = events.Muon[event_level]
-        smu = smu[:, 0]
-        sel = events.Electron[event_level]
-        sel = sel[:, 0]
-        sjets = event_jet[event_level]
+        # slicing events brings back the unfiltered collections, so only use
+        # sel_events for branches which are never overwritten above
+        sel_events = events[sel_idx]
+        # selected events carry exactly one filtered lepton each, no padding needed
+        smu = events.Muon[sel_idx][:, 0]
+        sel = events.Electron[sel_idx][:, 0]
+        sjets = event_jet[sel_idx]
         nseljet = ak.count(sjets.pt, axis=1)
         sjets = sjets[:, :2]
         # Find the PFCands associate with selected jets. Search from jetindex->JetPFCands->PFCand
         if "PFCands" in events.fields:
+            ## store jet index for PFCands, create mask on the jet index
+            # scatter the cleaning of the jet ID candidates back onto all jets,
+            # only for the selected events
+            sel_jid = jid[sel_idx]
+            jid_flat = ak.to_numpy(ak.flatten(sel_jid))
+            jet_sel = np.zeros(len(jid_flat), dtype=bool)
+            jet_sel[jid_flat] = ak.to_numpy(ak.flatten(jet_clean[sel_idx]))
+            jetindx = ak.mask(
+                ak.local_index(sel_events.Jet.pt),
+                ak.unflatten(jet_sel, ak.num(sel_jid)),
+            )
+            jetindx = ak.pad_none(jetindx, 2)
             jetindx0 = jetindx[:, 0]
             jetindx1 = jetindx[:, 1]
             spfcands = collections.defaultdict(dict)
-            spfcands[0] = events[event_level].PFCands[
-                events[event_level]
-                .JetPFCands[
-                    events[event_level].JetPFCands.jetIdx == jetindx0[event_level]
-                ]
-                .pFCandsIdx
+            spfcands[0] = sel_events.PFCands[
+                sel_events.JetPFCands[
+                    sel_events.JetPFCands.jetIdx == jetindx0
+                ].pFCandsIdx
             ]
-            spfcands[1] = events[event_level].PFCands[
-                events[event_level]
-                .JetPFCands[
-                    events[event_level].JetPFCands.jetIdx == jetindx1[event_level]
-                ]
-                .pFCandsIdx
+            spfcands[1] = sel_events.PFCands[
+                sel_events.JetPFCands[
+                    sel_events.JetPFCands.jetIdx == jetindx1
+                ].pFCandsIdx
             ]
         ####################
         # Weight & Geninfo #
         ####################
-        weights = Weights(len(events[event_level]), storeIndividual=True)
+        weights = Weights(sel_idx.size, storeIndividual=True)
         if not isRealData:
-            weights.add("genweight", events[event_level].genWeight)
+            weights.add("genweight", sel_events.genWeight)
             par_flav = (sjets.partonFlavour == 0) & (sjets.hadronFlavour == 0)
             genflavor = ak.values_astype(sjets.hadronFlavour + 1 * par_flav, int)
             if len(self.SF_map.keys()) > 0:
                 syst_wei = True if self.isSyst != False else False
                 if "PU" in self.SF_map.keys():
                     puwei(
-                        events[event_level].Pileup.nTrueInt,
+                        sel_events.Pileup.nTrueInt,
                         self.SF_map,
                         weights,
                         syst_wei,
@@ -308,134 +290,154 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         #  Fill histogram  #
         ####################
-        for syst in systematics:
-            if self.isSyst == False and syst != "nominal":
-                break
-            if self.noHist:
-                break
-            weight = (
-                weights.weight()
-                if syst == "nominal" or syst == shift_name
-                else weights.weight(modifier=syst)
-            )
-            for histname, h in output.items():
+        if not self.noHist:
+            # syst independent inputs, computed once instead of per histogram
+            nobtag_weight = weights.partial_weight(exclude=exclude_btv)
+            fill_btag_syst = not isRealData and "btag" in self.SF_map.keys()
+            # the two leading jets as (N, 2) numpy columns, each branch is
+            # converted once from the regular layout and sliced per jet
+            sjets_reg = ak.to_regular(sjets, axis=1)
+            jet_cols = {}
+            jet_genflavor = ak.to_numpy(ak.to_regular(genflavor, axis=1))
+            dr_mujet = [flatten(smu.delta_r(sjets[:, i])) for i in range(2)]
+            jet_nobtag_weight = np.repeat(nobtag_weight, ak.to_numpy(ak.num(sjets.pt)))
+            # resolve each histogram to its kind and filled values once, the syst
+            # loop below then runs over each group without any name parsing
+            hist_groups = {
+                "deep": [],
+                "pfcands": [],
+                "mu": [],
+                "ele": [],
+                # per-jet groups, indexed by the leading/subleading jet
+                "btag": [[], []],
+                "jet": [[], []],
+            }
+            for histname in output.keys():
                 if (
                     "Deep" in histname
                     and "btag" not in histname
                     and histname in events.Jet.fields
                 ):
-                    if syst != "nominal":
-                        continue
-                    h.fill(
-                        syst,
-                        flatten(genflavor),
-                        flatten(sjets[histname]),
-                        weight=flatten(
-                            ak.broadcast_arrays(
-                                weights.partial_weight(exclude=exclude_btv), sjets["pt"]
-                            )[0]
-                        ),
-                    )
+                    if histname not in jet_cols:
+                        jet_cols[histname] = ak.to_numpy(sjets_reg[histname])
+                    hist_groups["deep"].append((histname, jet_cols[histname].ravel()))
                 elif (
                     "PFCands" in events.fields
                     and "PFCands" in histname
                     and histname.split("_")[1] in events.PFCands.fields
                 ):
-                    if syst != "nominal":
-                        continue
-                    for i in range(2):
-                        h.fill(
-                            syst,
-                            flatten(
-                                ak.broadcast_arrays(
-                                    genflavor[:, i],
-                                    spfcands[i]["pt"],
-                                )[0]
-                            ),
-                            flatten(spfcands[i][histname.replace("PFCands_", "")]),
-                            weight=flatten(
-                                ak.broadcast_arrays(
-                                    weights.partial_weight(exclude=exclude_btv),
-                                    spfcands[i]["pt"],
-                                )[0]
-                            ),
+                    hist_groups["pfcands"].append(
+                        (
+                            histname,
+                            [
+                                flatten(spfcands[i][histname.replace("PFCands_", "")])
+                                for i in range(2)
+                            ],
                         )
-
+                    )
                 elif "btag" in histname:
                     for i in range(2):
-                        sel_jet = sjets[:, i]
-                        if (
-                            str(i) in histname
-                            and histname.replace(f"_{i}", "") in events.Jet.fields
-                        ):
-                            h.fill(
-                                "noSF",
-                                flav=flatten(genflavor[:, i]),
-                                discr=flatten(sel_jet[histname.replace(f"_{i}", "")]),
-                                weight=weights.partial_weight(exclude=exclude_btv),
-                            )
-                            if not isRealData and "btag" in self.SF_map.keys():
-                                h.fill(
-                                    syst=syst,
-                                    flav=flatten(
-                                        ak.values_astype(
-                                            genflavor[:, i],
-                                            np.uint8,
-                                        )
-                                    ),
-                                    discr=flatten(
-                                        sel_jet[histname.replace(f"_{i}", "")]
-                                    ),
-                                    weight=weight,
-                                )
+                        field = histname.replace(f"_{i}", "")
+                        if str(i) not in histname or field not in events.Jet.fields:
+                            continue
+                        if field not in jet_cols:
+                            jet_cols[field] = ak.to_numpy(sjets_reg[field])
+                        hist_groups["btag"][i].append((histname, jet_cols[field][:, i]))
                 elif "mu_" in histname and histname.replace("mu_", "") in smu.fields:
-                    h.fill(
-                        syst,
-                        flatten(smu[histname.replace("mu_", "")]),
-                        weight=weight,
+                    hist_groups["mu"].append(
+                        (histname, flatten(smu[histname.replace("mu_", "")]))
                     )
                 elif "ele_" in histname and histname.replace("ele_", "") in sel.fields:
-                    h.fill(
-                        syst,
-                        flatten(sel[histname.replace("ele_", "")]),
-                        weight=weight,
+                    hist_groups["ele"].append(
+                        (histname, flatten(sel[histname.replace("ele_", "")]))
                     )
                 elif "jet" in histname and "dr" not in histname and "njet" != histname:
                     for i in range(2):
-                        sel_jet = sjets[:, i]
-                        if str(i) in histname:
-                            h.fill(
-                                syst,
-                                flatten(genflavor[:, i]),
-                                flatten(sel_jet[histname.replace(f"jet{i}_", "")]),
+                        if str(i) not in histname:
+                            continue
+                        field = histname.replace(f"jet{i}_", "")
+                        if field not in jet_cols:
+                            jet_cols[field] = ak.to_numpy(sjets_reg[field])
+                        hist_groups["jet"][i].append((histname, jet_cols[field][:, i]))
+            # b-tag inputs only take the nominal fill, once outside the syst loop
+            if "nominal" in systematics:
+                for histname, var in hist_groups["deep"]:
+                    output[histname].fill(
+                        "nominal",
+                        jet_genflavor.ravel(),
+                        var,
+                        weight=jet_nobtag_weight,
+                    )
+                for i in range(2):
+                    if len(hist_groups["pfcands"]) == 0:
+                        break
+                    pf_genflavor = flatten(
+                        ak.broadcast_arrays(genflavor[:, i], spfcands[i]["pt"])[0]
+                    )
+                    pf_nobtag_weight = np.repeat(
+                        nobtag_weight,
+                        ak.to_numpy(ak.fill_none(ak.num(spfcands[i]["pt"]), 0)),
+                    )
+                    for histname, var in hist_groups["pfcands"]:
+                        output[histname].fill(
+                            "nominal",
+                            pf_genflavor,
+                            var[i],
+                            weight=pf_nobtag_weight,
+                        )
+            for syst in systematics:
+                if self.isSyst == False and syst != "nominal":
+                    break
+                weight = (
+                    weights.weight()
+                    if syst == "nominal" or syst == shift_name
+                    else weights.weight(modifier=syst)
+                )
+                for histname, var in hist_groups["mu"] + hist_groups["ele"]:
+                    output[histname].fill(syst, var, weight=weight)
+                # one pass per jet over all histograms filled from that jet
+                for i in range(2):
+                    flav = jet_genflavor[:, i]
+                    for histname, discr in hist_groups["btag"][i]:
+                        output[histname].fill(
+                            "noSF",
+                            flav=flav,
+                            discr=discr,
+                            weight=nobtag_weight,
+                        )
+                        if fill_btag_syst:
+                            output[histname].fill(
+                                syst=syst,
+                                flav=flav,
+                                discr=discr,
                                 weight=weight,
                             )
-
-            for i in range(2):
-                output[f"dr_mujet{i}"].fill(
-                    syst,
-                    flav=flatten(genflavor[:, i]),
-                    dr=flatten(smu.delta_r(sjets[:, i])),
-                    weight=weight,
-                )
-            output["njet"].fill(syst, nseljet, weight=weight)
-            output["npvs"].fill(
-                syst,
-                events[event_level].PV.npvs,
-                weight=weight,
-            )
-            if not isRealData:
-                output["pu"].fill(
+                    for histname, jet_var in hist_groups["jet"][i]:
+                        output[histname].fill(syst, flav, jet_var, weight=weight)
+                    output[f"dr_mujet{i}"].fill(
+                        syst,
+                        flav=flav,
+                        dr=dr_mujet[i],
+                        weight=weight,
+                    )
+                output["njet"].fill(syst, nseljet, weight=weight)
+                output["npvs"].fill(
                     syst,
-                    events[event_level].Pileup.nTrueInt,
+                    sel_events.PV.npvs,
                     weight=weight,
                 )
+                if not isRealData:
+                    output["pu"].fill(
+                        syst,
+                        sel_events.Pileup.nTrueInt,
+                        weight=weight,
+                    )
         #######################
         #  Create root files  #
         #######################
         if self.isArray:
             # Keep the structure of events and pruned the object size
-            pruned_ev = events[event_level]
+            pruned_ev = sel_events
             pruned_ev["SelJet"] = sjets
             pruned_ev["Muon"] = smu
             pruned_ev["Electron"] = sel